@@ -1,22 +1,160 @@
 #!/usr/bin/env python3
 
-from threading import Thread
-from urllib.request import Request, urlopen
+import os
+import stat
+import sys
+from threading import Thread, Event, Lock
+from queue import Queue, Empty
+from shutil import copyfileobj
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPSConnection, HTTPException, HTTPResponse
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+from urllib.request import Request, getproxies, proxy_bypass, urlopen
 from enum import Enum
 import tkinter as tk
 from tkinter import ttk
 
 
-class Download:
-    MAX_CHUNK_SIZE = 1024
+# Response of an unencrypted HTTP connection, whose body can be moved
+# straight from the socket to a file.
+class _PlainHTTPResponse(HTTPResponse):
+    pass
+
+
+# Keeps idle HTTP(S) connections around so that later requests to the same
+# host skip the TCP and TLS handshakes.
+class _ConnectionPool:
+    MAX_IDLE_CONNECTIONS = 16  # per host
+    MAX_REDIRECTS = 10
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+    # Same as urlopen sends, some servers reject requests without one.
+    USER_AGENT = "Python-urllib/%d.%d" % sys.version_info[:2]
+
+    def __init__(self):
+        self._idle = {}  # (scheme, host) -> idle connections
+        self._lock = Lock()
+
+    @contextmanager
+    def open(self, url, headers):
+        url, key, connection, response = self._request(url, headers)
+
+        # Other schemes (file, ftp, ...) and requests that have to go through
+        # a proxy are left to urllib.
+        if response is None:
+            with urlopen(Request(url, headers=headers)) as response:
+                yield response
+            return
+
+        try:
+            yield response
+        finally:
+            self._release(key, connection, response)
+
+    def _pooled(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            return False
+        return parts.scheme not in getproxies() or proxy_bypass(parts.netloc)
+
+    def _request(self, url, headers):
+        # Returns the URL, connection key, connection and response, the last
+        # three None if the URL (or a redirect) is not for the pool.
+        headers = {"User-Agent": self.USER_AGENT, **headers}
+        for _ in range(self.MAX_REDIRECTS + 1):
+            if not self._pooled(url):
+                return url, None, None, None
+
+            parts = urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+
+            connection, response = self._send(key, path, headers)
+
+            location = response.headers["location"]
+            if response.status in self.REDIRECT_STATUSES and location:
+                response.read()
+                self._release(key, connection, response)
+                url = urljoin(url, location)
+                continue
+
+            if response.status >= 400:
+                self._release(key, connection, response)
+                raise HTTPError(url, response.status, response.reason,
+                                response.headers, None)
+
+            return url, key, connection, response
+
+        raise HTTPException(f"Too many redirects: {url}")
+
+    def _send(self, key, path, headers):
+        connection = self._get(key)
+        if connection is not None:
+            try:
+                connection.request("GET", path, headers=headers)
+                return connection, connection.getresponse()
+            except (HTTPException, OSError):
+                # The server closed the idle connection, open a new one.
+                connection.close()
+
+        scheme, netloc = key
+        if scheme == "https":
+            connection = HTTPSConnection(netloc)
+        else:
+            connection = HTTPConnection(netloc)
+            connection.response_class = _PlainHTTPResponse
+        connection.request("GET", path, headers=headers)
+        return connection, connection.getresponse()
+
+    def _get(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            return idle.pop() if idle else None
+
+    def _release(self, key, connection, response):
+        # Only a response that was read to the end leaves the connection
+        # ready for another request.
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.MAX_IDLE_CONNECTIONS:
+                    idle.append(connection)
+                    return
+        connection.close()
+
 
-    def __init__(self, url):
+class Download:
+    MAX_CHUNK_SIZE = 128 * 1024
+    # Large downloads from servers that accept range requests are split into
+    # segments that are downloaded over separate connections.
+    MAX_CONNECTIONS = 4
+    MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+    # Shared by all downloads so connections are reused across them.
+    _connection_pool = _ConnectionPool()
+
+    def __init__(self, url, on_change=None):
         super().__init__()
         self._url = url
+        # Last part of the URL path, where the download is saved.
+        self._filename = urlsplit(url).path.rsplit('/', 1)[-1] or "download"
+        # Called, possibly from a download thread, with this download
+        # whenever its size, progress or status changes.
+        self._on_change = on_change
         self._size = -1  # size of download in bytes
         self._downloaded = 0  # number of bytes downloaded
+        self._progress = 0  # percent downloaded, kept up by _advance
+        self._downloaded_lock = Lock()
+        self._segments = None  # byte ranges, split once the size is known
         self._status = self.Status.DOWNLOADING
-        self._download()
+        # Cleared while the download is paused or failed, the worker thread
+        # waits on it before downloading again.
+        self._resume_event = Event()
+        self._resume_event.set()
+        self._status_lock = Lock()
+        worker_thread = Thread(target=self._work, daemon=True)
+        worker_thread.start()
 
     @property
     def url(self):
@@ -28,76 +166,357 @@ class Download:
 
     @property
     def progress(self):
-        return int(self._downloaded / self.size * 100)
+        return self._progress
 
     @property
     def status(self):
         return self._status
 
-    def _download(self):
-        download_thread = Thread(target=self._run, daemon=True)
-        download_thread.start()
-
     def pause(self):
-        self._status = self.Status.PAUSED
+        self._set_status(self.Status.PAUSED, resume=False)
 
     def resume(self):
-        self._status = self.Status.DOWNLOADING
-        self._download()
+        self._set_status(self.Status.DOWNLOADING, resume=True)
 
     def cancel(self):
-        self._status = self.Status.CANCELLED
+        # Setting the resume event lets a waiting worker thread finish.
+        self._set_status(self.Status.CANCELLED, resume=True)
 
     def _error(self):
-        self._status = self.Status.ERROR
+        self._set_status(self.Status.ERROR, resume=False)
+
+    def _complete(self):
+        # Only a download still downloading completes, not one that was
+        # paused or cancelled after its last byte arrived.
+        with self._status_lock:
+            complete = (self._status is self.Status.DOWNLOADING
+                        and all(segment.done for segment in self._segments))
+            if complete:
+                self._status = self.Status.COMPLETE
+        if complete:
+            self._changed()
+
+    def _set_status(self, status, resume):
+        # The status and the resume event are changed together under
+        # _status_lock, so the worker thread never wakes up to a failed or
+        # paused download. Complete and cancelled downloads have no worker
+        # thread left and stay as they are. Listeners are told after the
+        # lock is released.
+        with self._status_lock:
+            if self._status in (self.Status.COMPLETE, self.Status.CANCELLED):
+                return
+            self._status = status
+            if resume:
+                self._resume_event.set()
+            else:
+                self._resume_event.clear()
+        self._changed()
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change(self)
+
+    def _work(self):
+        # The one thread a download runs on, from start to completion or
+        # cancellation, waiting whenever the download is paused or failed.
+        while True:
+            self._resume_event.wait()
+            if self._status is self.Status.CANCELLED:
+                return
+
+            self._run()
+            if self._status in (self.Status.COMPLETE, self.Status.CANCELLED):
+                return
 
     def _run(self):
         try:
-            request = Request(self._url)
-            request.add_header("Range", f"bytes={self._downloaded}-")
-            with urlopen(request) as response:
-                content_length = int(response.headers["content-length"])
-
-                if self._size == -1:
-                    self._size = content_length
-
-                filename = self._url.split('/')[-1]
-                with open(filename, 'wb') as file:
-                    file.seek(self._downloaded)
-                    while self._status == self.Status.DOWNLOADING:
-                        chunk_size = self._size - self._downloaded
-                        if chunk_size > self.MAX_CHUNK_SIZE:
-                            chunk_size = self.MAX_CHUNK_SIZE
-
-                        chunk = response.read(chunk_size)
-                        if not chunk:
-                            break
-                        file.write(chunk)
-
-                        self._downloaded += chunk_size
-
-            if self._status == self.Status.DOWNLOADING:
-                self._status = self.Status.COMPLETE
-        except:
+            if self._segments is None:
+                headers = {"Range": "bytes=0-"}
+                with self._connection_pool.open(self._url, headers) as response:
+                    self._size = int(response.headers["content-length"])
+                    self._changed()
+                    segments = self._split(response.status == 206)
+
+                    with open(self._filename, 'wb') as file:
+                        self._allocate(file)
+
+                    # Only a download whose file exists is resumed from its
+                    # segments, otherwise the next run starts over.
+                    self._segments = segments
+                    self._download_segments(self._segments, response)
+            else:
+                self._download_segments([
+                    segment for segment in self._segments if not segment.done])
+
+            # Segments left over with the download still downloading were
+            # stopped by a pause that was resumed right away, and are picked
+            # up again by the next run.
+            self._complete()
+        except Exception:
             self._error()
 
+    def _allocate(self, file):
+        # Reserve the whole file up front so the filesystem can lay it out
+        # in one go instead of growing it with every write.
+        try:
+            os.posix_fallocate(file.fileno(), 0, self._size)
+        except (AttributeError, OSError):  # not supported on this platform
+            file.truncate(self._size)
+
+    def _split(self, accepts_ranges):
+        count = min(self.MAX_CONNECTIONS,
+                    self._size // self.MIN_SEGMENT_SIZE)
+        if not accepts_ranges or count < 2:
+            return [_Segment(0, self._size)]
+
+        bounds = [self._size * i // count for i in range(count + 1)]
+        return [_Segment(start, end) for start, end in zip(bounds, bounds[1:])]
+
+    def _download_segments(self, segments, response=None):
+        # The first segment is downloaded on this thread, using the given
+        # response if there is one, and the rest on threads of their own.
+        if not segments:
+            return
+
+        threads = [Thread(target=self._download_segment, args=(segment,),
+                          daemon=True)
+                   for segment in segments[1:]]
+        for thread in threads:
+            thread.start()
+
+        self._download_segment(segments[0], response)
+
+        for thread in threads:
+            thread.join()
+
+    def _download_segment(self, segment, response=None):
+        try:
+            if response is None:
+                headers = {"Range": f"bytes={segment.offset}-{segment.end - 1}"}
+                with self._connection_pool.open(self._url, headers) as response:
+                    self._copy_segment(segment, response)
+            else:
+                self._copy_segment(segment, response)
+        except Exception:
+            self._error()
+
+    def _copy_segment(self, segment, response):
+        source = self._sendfile_source(response)
+
+        # A server that ignores the range sends the whole file from the
+        # start, which can only be used if this is the only segment.
+        if source is None and response.status != 206 and segment.offset != 0:
+            if len(self._segments) > 1:
+                raise HTTPException("Server no longer accepts range requests")
+            self._advance(segment, -segment.offset)
+
+        # Each segment writes through its own file object, so the threads
+        # don't share a file position.
+        with open(self._filename, 'r+b', buffering=self.MAX_CHUNK_SIZE) as file:
+            file.seek(segment.offset)
+            if source is not None:
+                self._send_segment(file, segment, source)
+            elif self._can_splice(response):
+                self._splice_segment(file, segment, response)
+            else:
+                copyfileobj(_DownloadReader(self, segment, response),
+                            file, self.MAX_CHUNK_SIZE)
+
+    def _sendfile_source(self, response):
+        # Responses backed by a local file (file:// URLs) can be copied by
+        # the kernel with sendfile, which outside Linux only writes to
+        # sockets. Returns the file descriptor to copy from, if any.
+        if not sys.platform.startswith("linux"):
+            return None
+
+        try:
+            source = response.fileno()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+        return source if stat.S_ISREG(os.fstat(source).st_mode) else None
+
+    def _send_segment(self, file, segment, source):
+        # The source holds the whole file, so the segment can be read at its
+        # own offset whether or not the range was honoured.
+        # Attributes used on every pass are bound to locals up front.
+        sendfile = os.sendfile
+        destination = file.fileno()
+        max_chunk_size = self.MAX_CHUNK_SIZE
+        downloading = self.Status.DOWNLOADING
+        end = segment.end
+        while self._status is downloading and segment.offset < end:
+            sent = sendfile(destination, source, segment.offset,
+                            min(max_chunk_size, end - segment.offset))
+            if not sent:
+                raise EOFError("Local file ended before the download did")
+            self._advance(segment, sent)
+
+    def _can_splice(self, response):
+        # Bodies sent as they are over plain HTTP can be moved from the
+        # socket to the file by the kernel with splice (Linux only), as
+        # sendfile cannot read from sockets.
+        return (hasattr(os, "splice")
+                and isinstance(response, _PlainHTTPResponse)
+                and not response.chunked and response.length is not None
+                and response.headers.get("content-encoding", "identity") == "identity")
+
+    def _splice_segment(self, file, segment, response):
+        end = segment.end
+        body_length = response.length
+
+        copied = 0
+
+        # http.client may already have buffered the start of the body, the
+        # rest is still in the socket. peek() returns what is buffered, or
+        # fills the empty buffer with one read of at most its size, so no
+        # more than one buffer (8 KiB) of the body passes through user space
+        # here. An empty segment has nothing to read.
+        if segment.offset < end:
+            size = min(len(response.fp.peek(0)), end - segment.offset)
+            if size:
+                file.write(response.fp.read1(size))
+                file.flush()
+                self._advance(segment, size)
+                copied = size
+
+        # Attributes used on every pass are bound to locals up front.
+        splice = os.splice
+        source = response.fileno()
+        destination = file.fileno()
+        max_chunk_size = self.MAX_CHUNK_SIZE
+        downloading = self.Status.DOWNLOADING
+        pipe_out, pipe_in = os.pipe()
+        try:
+            while self._status is downloading and segment.offset < end:
+                size = splice(source, pipe_in,
+                              min(max_chunk_size, end - segment.offset))
+                if not size:
+                    raise EOFError("Response ended before the download did")
+
+                moved = 0
+                while moved < size:
+                    moved += splice(pipe_out, destination, size - moved,
+                                    offset_dst=segment.offset + moved)
+                self._advance(segment, size)
+                copied += size
+        finally:
+            os.close(pipe_out)
+            os.close(pipe_in)
+
+        # The body was read behind http.client's back, so tell it once all
+        # of it is gone and the connection can be reused.
+        if copied == body_length:
+            response.close()
+
+    def _advance(self, segment, size):
+        if not size:
+            return
+
+        segment.offset += size
+        with self._downloaded_lock:
+            self._downloaded += size
+            progress = (self._downloaded * 100 // self._size
+                        if self._size > 0 else 0)
+            changed = progress != self._progress
+            self._progress = progress
+
+        if changed:
+            self._changed()
+
     class Status(Enum):
-        DOWNLOADING = "Downloading",
-        PAUSED = "Paused",
-        COMPLETE = "Complete",
-        CANCELLED = "Cancelled",
+        DOWNLOADING = "Downloading"
+        PAUSED = "Paused"
+        COMPLETE = "Complete"
+        CANCELLED = "Cancelled"
         ERROR = "Error"
 
 
+# Range of bytes [offset, end) of a download still to be downloaded.
+class _Segment:
+    def __init__(self, offset, end):
+        self.offset = offset
+        self.end = end
+
+    @property
+    def done(self):
+        return self.offset == self.end
+
+
+# Response wrapper for copyfileobj that counts the bytes written, stops at
+# the end of the segment and reports end of file once the download is no
+# longer downloading.
+class _DownloadReader:
+    # Written bytes are added to the download in batches of at least this
+    # many, so locking and progress updates stay out of the copy loop.
+    COUNT_INTERVAL = 8 * Download.MAX_CHUNK_SIZE
+
+    def __init__(self, download, segment, response):
+        self._download = download
+        self._segment = segment
+        self._offset = segment.offset  # next byte to read from the response
+        # Bound once, read() is called for every chunk.
+        self._readinto = response.readinto
+        self._end = segment.end
+        self._downloading = Download.Status.DOWNLOADING
+        # Every chunk is read into this one buffer instead of a new bytes
+        # object, which is fine as copyfileobj writes it before reading on.
+        self._buffer = memoryview(bytearray(Download.MAX_CHUNK_SIZE))
+
+    def read(self, size=-1):
+        # copyfileobj writes each chunk before reading the next one, so
+        # every byte read so far is in the file by now.
+        remaining = self._end - self._offset
+        stopping = (not remaining
+                    or self._download._status is not self._downloading)
+        uncounted = self._offset - self._segment.offset
+        if stopping or uncounted >= self.COUNT_INTERVAL:
+            self._count()
+        if stopping:
+            return b""
+
+        if size < 0 or size > remaining:
+            size = remaining
+
+        size = self._readinto(self._buffer[:size])
+        if not size:
+            self._count()
+            raise EOFError("Response ended before the download did")
+        self._offset += size
+        return self._buffer[:size]
+
+    def _count(self):
+        self._download._advance(
+            self._segment, self._offset - self._segment.offset)
+
+
 class DownloadManager(ttk.Frame):
+    # Whether the pause, resume, cancel and clear buttons are disabled, by
+    # status of the selected download (None when nothing is selected).
+    BUTTON_STATES = {
+        None: (True, True, True, True),
+        Download.Status.DOWNLOADING: (False, True, False, True),
+        Download.Status.PAUSED: (True, False, False, True),
+        Download.Status.ERROR: (True, False, True, False),
+        Download.Status.COMPLETE: (True, True, True, False),
+        Download.Status.CANCELLED: (True, True, True, False),
+    }
+
     def __init__(self, master=None):
         super().__init__(master, padding=5)
-        self._downloads = []
+        self._downloads = {}  # by table item id
         self._selected_download = None
         # Flag for whether or not table selection is being cleared.
         self._clearing = False
+        # Downloads whose changes are not shown yet, filled by download
+        # threads and drained on <<DownloadChanged>>.
+        self._changed_downloads = Queue()
+        # Values last shown in the table for each download, by item id.
+        self._last_values = {}
+        # Button states last applied, see BUTTON_STATES.
+        self._button_states = None
         self._create_widgets()
-        self.master.after(100, self._update_downloads)
+        self.bind("<<DownloadChanged>>", self._update_downloads)
 
     def _create_widgets(self):
         self.master.title("Download manager")
@@ -180,31 +599,55 @@ class DownloadManager(ttk.Frame):
         return download_buttons_frame
 
     def _add_download(self):
-        download = Download(self._download_url_entry.get())
+        download = Download(self._download_url_entry.get(),
+                            on_change=self._download_changed)
 
-        self._downloads.append(download)
-        self._downloads_treeview.insert(parent="", index=tk.END, iid=id(download), values=(
-            download.url, download.size, download.progress, download.status.value))
+        item = str(id(download))
+        self._downloads[item] = download
+        values = self._download_values(download)
+        self._downloads_treeview.insert(
+            parent="", index=tk.END, iid=item, values=values)
+        self._last_values[item] = values
 
         self._download_url_entry.delete(0, tk.END)
 
     def _selected_download_changed(self, event):
         # If not in the middle of clearing a download, set the selected download.
-        if not self._clearing and self._downloads_treeview.selection() is not None:
-            selected_index = self._downloads_treeview.index(
-                self._downloads_treeview.selection()[0])
-            self._selected_download = self._downloads[selected_index]
+        selection = self._downloads_treeview.selection()
+        if not self._clearing and selection:
+            self._selected_download = self._downloads[selection[0]]
             self._update_download_buttons()
 
-    def _update_downloads(self):
-        for download in self._downloads:
-            self._downloads_treeview.item(id(download), values=(
-                download.url, download.size, download.progress, download.status.value))
+    def _download_changed(self, download):
+        self._changed_downloads.put(download)
+        try:
+            self.event_generate("<<DownloadChanged>>", when="tail")
+        except (RuntimeError, tk.TclError):
+            pass  # the main loop has already ended
+
+    def _update_downloads(self, event):
+        changed_downloads = set()
+        while True:
+            try:
+                changed_downloads.add(self._changed_downloads.get_nowait())
+            except Empty:
+                break
+
+        for download in changed_downloads:
+            # Skip downloads that were cleared in the meantime and rows
+            # that would not change.
+            item = str(id(download))
+            last_values = self._last_values.get(item)
+            values = self._download_values(download)
+            if last_values is not None and values != last_values:
+                self._downloads_treeview.item(item, values=values)
+                self._last_values[item] = values
 
             if (download is self._selected_download):
                 self._update_download_buttons()
 
-        self.master.after(100, self._update_downloads)
+    def _download_values(self, download):
+        return (download.url, download.size, download.progress, download.status.value)
 
     def _pause_download(self):
         self._selected_download.pause()
@@ -222,7 +665,10 @@ class DownloadManager(ttk.Frame):
         self._clearing = True
 
         selected_item = self._downloads_treeview.selection()[0]
-        del self._downloads[self._downloads_treeview.index(selected_item)]
+        # Cancelling ends the worker thread of a failed download, which
+        # would otherwise wait for a resume forever.
+        self._downloads.pop(selected_item).cancel()
+        del self._last_values[selected_item]
         self._downloads_treeview.delete(selected_item)
 
         self._clearing = False
@@ -230,32 +676,19 @@ class DownloadManager(ttk.Frame):
         self._update_download_buttons()
 
     def _update_download_buttons(self):
-        if self._selected_download is not None:
-            if self._selected_download.status == Download.Status.DOWNLOADING:
-                self._pause_button.state(["!disabled"])
-                self._resume_button.state(["disabled"])
-                self._cancel_button.state(["!disabled"])
-                self._clear_button.state(["disabled"])
-            elif self._selected_download.status == Download.Status.PAUSED:
-                self._pause_button.state(["disabled"])
-                self._resume_button.state(["!disabled"])
-                self._cancel_button.state(["!disabled"])
-                self._clear_button.state(["disabled"])
-            elif self._selected_download.status == Download.Status.ERROR:
-                self._pause_button.state(["disabled"])
-                self._resume_button.state(["!disabled"])
-                self._cancel_button.state(["disabled"])
-                self._clear_button.state(["!disabled"])
-            else:  # COMPLETE or CANCELLED
-                self._pause_button.state(["disabled"])
-                self._resume_button.state(["disabled"])
-                self._cancel_button.state(["disabled"])
-                self._clear_button.state(["!disabled"])
-        else:
-            self._pause_button.state(["disabled"])
-            self._resume_button.state(["disabled"])
-            self._cancel_button.state(["disabled"])
-            self._clear_button.state(["disabled"])
+        status = (self._selected_download.status
+                  if self._selected_download is not None else None)
+        button_states = self.BUTTON_STATES[status]
+        if button_states == self._button_states:
+            return
+
+        buttons = (self._pause_button, self._resume_button,
+                   self._cancel_button, self._clear_button)
+        for button, disabled, was_disabled in zip(
+                buttons, button_states, self._button_states or (None,) * 4):
+            if disabled != was_disabled:
+                button.state(["disabled" if disabled else "!disabled"])
+        self._button_states = button_states
 
 
 if __name__ == "__main__":